@@ -1,18 +1,27 @@
 import datetime
+import io
 import json
+import math
 import os
 import psycopg2
 import pytz
+import random
 import re
+import threading
+import time
 import uuid
-from flask import Flask, flash, redirect, render_template, request, g, make_response, send_file
+from cachetools import TTLCache
+from flask import Flask, Response, flash, jsonify, redirect, render_template, request, g, make_response, send_file, stream_with_context
 from functools import wraps
 import geoip2.database
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from urllib.parse import urlparse
 from user_agents import parse
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from helpers import apology, recipe_route, get_image_link, separate_content, get_recipe_content
+from credentials import CredentialsBusy, hash_password, needs_rehash, verify_password
+from helpers import apology, recipe_route, get_image_link, separate_content, get_recipe_content, parse_recipe_archive, import_recipe, normalize_url
+from ingredients import IngredientIndex, add_parsed_ingredients, ingredient_names, unit_table
+from ratelimit import MemoryBackend, PostgresBackend, RateLimiter, Throttled
 
 
 # Configure application
@@ -26,6 +35,21 @@ app.config['SECRET_KEY'] = os.environ["SECRET_FLASK_KEY"]
 
 DATABASE_URL = os.environ["DATABASE_URL"]
 
+# Optional read replicas, comma separated
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Replicas further behind the primary than this (seconds) are skipped
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))
+# Seconds to wait before trying a down or lagging replica again
+REPLICA_RETRY = 30
+# Seconds between lag checks on a healthy replica
+REPLICA_CHECK_INTERVAL = 5
+# Seconds a browser keeps reading from the primary after a write, so redirects and reloads see it
+## A replica can fall up to a check interval further behind than REPLICA_MAX_LAG between checks
+PRIMARY_PIN = REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL
+
+replica_skip_until = {}
+replica_checked = {}
+
 # Get a database connection
 def get_db():
     db = getattr(g, '_database', None)
@@ -33,15 +57,101 @@ def get_db():
         db = g._database = psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor)
     return db
 
+# Get a replica connection, or None to use the primary
+def get_replica():
+    replica = getattr(g, '_replica', None)
+    if replica is None:
+        replica = g._replica = connect_replica() or False
+    return replica or None
+
+def connect_replica():
+    now = time.monotonic()
+    urls = [url for url in DATABASE_REPLICA_URLS if replica_skip_until.get(url, 0) <= now]
+    random.shuffle(urls)
+    for url in urls:
+        try:
+            replica = psycopg2.connect(url, cursor_factory=DictCursor, connect_timeout=2)
+        except psycopg2.OperationalError:
+            replica_skip_until[url] = now + REPLICA_RETRY
+            continue
+        replica.autocommit = True
+        g._replica_url = url
+
+        if now - replica_checked.get(url, 0) > REPLICA_CHECK_INTERVAL:
+            try:
+                # Compare with the primary's position, a replica that stopped receiving WAL has nothing left to replay either
+                cur = get_db().cursor()
+                cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+                primary_lsn = cur.fetchone()['lsn']
+                cur.close()
+
+                # Caught up -> no lag even if the primary has been idle, otherwise time since the last replayed transaction
+                cur = replica.cursor()
+                cur.execute(
+                    "SELECT CASE WHEN pg_last_wal_replay_lsn() >= %s::pg_lsn THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag",
+                    (primary_lsn,)
+                )
+                lag = cur.fetchone()['lag']
+                cur.close()
+            except psycopg2.Error:
+                lag = None
+            if lag is None or lag > REPLICA_MAX_LAG:
+                replica.close()
+                replica_skip_until[url] = now + REPLICA_RETRY
+                continue
+            replica_checked[url] = now
+        return replica
+    return None
+
 # Close database connection
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
         db.close()
+    replica = getattr(g, '_replica', None)
+    if replica:
+        replica.close()
+
+WRITE_TABLES = re.compile(r'\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)', re.IGNORECASE)
+READ_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)', re.IGNORECASE)
+
+# True while this browser is pinned to the primary by a recent write
+def pinned_to_primary():
+    try:
+        return float(request.cookies.get('primary_until', 0)) > time.time()
+    except ValueError:
+        return False
+
+# Reads go to a replica unless they touch a table this request already wrote to or a recent request wrote (read-your-writes)
+def use_replica(query):
+    if not DATABASE_REPLICA_URLS or not query.lstrip().upper().startswith("SELECT") or pinned_to_primary():
+        return False
+    written = getattr(g, '_written_tables', set())
+    return not any(table.lower() in written for table in READ_TABLES.findall(query))
 
 # Function to execute queries
-def query_db(query, args=(), fetch=True):
+## Writes pin the browser to the primary for PRIMARY_PIN seconds, pin=False for bookkeeping later requests don't read back
+def query_db(query, args=(), fetch=True, pin=True):
+    tables = WRITE_TABLES.findall(query)
+    if tables:
+        g._written_tables = getattr(g, '_written_tables', set()) | {table.lower() for table in tables}
+        g._pin_primary = getattr(g, '_pin_primary', False) or pin
+    elif fetch and use_replica(query):
+        replica = get_replica()
+        if replica is not None:
+            try:
+                cur = replica.cursor()
+                cur.execute(query, args)
+                rv = cur.fetchall()
+                cur.close()
+                return process_rows(rv)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Replica went down -> fail over to the primary
+                replica_skip_until[g._replica_url] = time.monotonic() + REPLICA_RETRY
+                replica.close()
+                g._replica = False
+
     db = get_db()
     cur = db.cursor()
     cur.execute(query, args)
@@ -63,12 +173,62 @@ def process_rows(rows):
         processed_rows.append(row_dict)
     return processed_rows
 
+# Rate limits for routes that do expensive outbound work
+## Set RATE_LIMIT_BACKEND=postgres to share buckets between processes
+if os.environ.get("RATE_LIMIT_BACKEND") == "postgres":
+    limiter = RateLimiter(PostgresBackend(lambda: psycopg2.connect(DATABASE_URL, connect_timeout=2)))
+else:
+    limiter = RateLimiter(MemoryBackend())
+# Url imports per user and per target site, image uploads per user (requests, seconds)
+limiter.limit("import-user", 30, 60)
+limiter.limit("import-site", 60, 60)
+limiter.limit("upload-user", 10, 60)
+# Requests running at once per worker, and fetches at once per target site
+limiter.cap("add-card-by-url", 4)
+limiter.cap("add-card", 4)
+limiter.cap("import-site", 2)
+
+def concurrency_limited(name):
+    """Decorate routes to shed POSTs once too many are running"""
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != "POST":
+                return f(*args, **kwargs)
+            limiter.acquire(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                limiter.release(name)
+        return decorated_function
+    return decorator
+
+# Over a limit -> answer right away so cheap routes keep their workers
+@app.errorhandler(Throttled)
+def throttled(e):
+    if e.status == 503:
+        response = make_response(apology("server busy, try again", 503))
+    else:
+        response = make_response(apology("too many requests, try again later", 429))
+    response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return response
+
+# Password hashing queue is full -> fail fast instead of tying up the worker
+@app.errorhandler(CredentialsBusy)
+def credentials_busy(e):
+    response = make_response(apology("server busy, try again", 503))
+    response.headers["Retry-After"] = "1"
+    return response
+
 @app.after_request
 def after_request(response):
     """Ensure responses aren't cached"""
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
+    if DATABASE_REPLICA_URLS and getattr(g, '_pin_primary', False):
+        response.set_cookie('primary_until', str(time.time() + PRIMARY_PIN), max_age=math.ceil(PRIMARY_PIN), httponly=True, secure=True, samesite='Lax')
     return response
 
 
@@ -154,16 +314,31 @@ def login_required(f):
         
         # Extend session
         current_time = datetime.datetime.now(pytz.utc)
-        query_db("UPDATE sessions SET time = %s WHERE session_id = %s", (current_time, session_id), fetch=False)
+        query_db("UPDATE sessions SET time = %s WHERE session_id = %s", (current_time, session_id), fetch=False, pin=False)
 
         # Delete any other sessions
-        query_db("DELETE FROM sessions WHERE user_id = %s AND session_id != %s", (user_id, session_id), fetch=False)
+        query_db("DELETE FROM sessions WHERE user_id = %s AND session_id != %s", (user_id, session_id), fetch=False, pin=False)
 
 
         return f(*args, **kwargs)
     return decorated_function
 
 
+# Admin account, the admin pages are hidden when it isn't set
+ADMIN_USER_ID = int(os.environ["ADMIN_USER_ID"]) if os.environ.get("ADMIN_USER_ID") else None
+
+def admin_required(f):
+    """Decorate routes to require the admin account"""
+
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if ADMIN_USER_ID is None or get_user_id() != ADMIN_USER_ID:
+            return apology("not found", 404)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def get_user_id():
     user_id = query_db("SELECT user_id FROM sessions WHERE session_id = %s", (request.cookies.get('session_id'),), fetch=True)
 
@@ -173,6 +348,35 @@ def get_user_id():
         return None
 
 
+# Delete recipes, leaving tombstones so synced clients drop them too
+def delete_recipes(condition, args):
+    query_db(
+        "WITH deleted AS (DELETE FROM recipes WHERE " + condition + " RETURNING route, user_id) INSERT INTO recipe_tombstones (route, user_id) SELECT route, user_id FROM deleted",
+        args, fetch=False
+    )
+
+
+# Ingredient indexes for users who searched recently, caught up with the change feed before each search
+ingredient_indexes = TTLCache(maxsize=256, ttl=3600)
+ingredient_indexes_lock = threading.Lock()
+
+def get_ingredient_index(user_id):
+    with ingredient_indexes_lock:
+        index = ingredient_indexes.get(user_id)
+        if index is None:
+            index = ingredient_indexes[user_id] = IngredientIndex()
+
+    # One refresh at a time so an older delta can't be applied over a newer one
+    with index.refreshing:
+        changed, deleted, cursor = recipe_changes(user_id, index.cursor)
+        index.update([(row['route'], row['title'], ingredient_names(row['contents'])) for row in changed], deleted, cursor)
+    return index
+
+def forget_ingredient_index(user_id):
+    with ingredient_indexes_lock:
+        ingredient_indexes.pop(user_id, None)
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_file('favicon.ico')
@@ -206,8 +410,15 @@ def login():
         # Ensure username exists and password is correct
         if len(rows) != 1:
             return apology("user not found", 400)
-        elif not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        elif not verify_password(rows[0]["hash"], request.form.get("password")):
             return apology("invalid password", 400)
+
+        # Upgrade the stored hash if the hash method or work factor changed
+        if needs_rehash(rows[0]["hash"]):
+            try:
+                query_db("UPDATE users SET hash = %s WHERE id = %s", (hash_password(request.form.get("password")), rows[0]['id']), fetch=False)
+            except CredentialsBusy:
+                pass
         
         #IP and User Agent
         user_ip = request.remote_addr or "0.0.0.0"
@@ -263,7 +474,7 @@ def register():
             return apology("username already taken", 400)
 
         # Log username and password
-        query_db("INSERT INTO users (username, hash) VALUES (%s, %s)", (username, generate_password_hash(password)), fetch=False)
+        query_db("INSERT INTO users (username, hash) VALUES (%s, %s)", (username, hash_password(password)), fetch=False)
 
         # IP and User Agent
         user_ip = request.remote_addr or "0.0.0.0"
@@ -306,7 +517,7 @@ def update_password():
     # Check password
     id = get_user_id()
     hash = query_db("SELECT hash FROM users WHERE id = %s", (id,), fetch=True)
-    if not check_password_hash(hash[0]["hash"], old):
+    if not verify_password(hash[0]["hash"], old):
         return apology("invalid password", 400)
 
     # Ensure password and confirmation match
@@ -314,7 +525,7 @@ def update_password():
         return apology("passwords must match", 400)
 
     # Update password
-    query_db("UPDATE users SET hash = %s WHERE id = %s", (generate_password_hash(password), id), fetch=False)
+    query_db("UPDATE users SET hash = %s WHERE id = %s", (hash_password(password), id), fetch=False)
 
     flash("Password Updated!")
 
@@ -336,7 +547,7 @@ def update_username():
     # Check password
     id = get_user_id()
     hash = query_db("SELECT hash FROM users WHERE id = %s", (id,), fetch=True)
-    if not check_password_hash(hash[0]["hash"], password):
+    if not verify_password(hash[0]["hash"], password):
         return apology("invalid password", 400)
 
     # Check if username taken
@@ -359,35 +570,76 @@ def delete_account():
 
     # Check password
     hash = query_db("SELECT hash FROM users WHERE id = %s", (id,), fetch=True)
-    if not check_password_hash(hash[0]["hash"], password):
+    if not verify_password(hash[0]["hash"], password):
         return 'Unauthorized', 401
 
     # Forget user data
     query_db("DELETE FROM users WHERE id = %s", (id,), fetch=False)
-    query_db("DELETE FROM recipes WHERE user_id = %s", (id,), fetch=False)
+    delete_recipes("user_id = %s", (id,))
     query_db("DELETE FROM sessions WHERE user_id = %s", (get_user_id(),), fetch=False)
+    forget_ingredient_index(id)
 
-    # Clear cookies and redirect home
+    # Clear cookies and redirect home, where the offline copy of the cards is dropped
     response = make_response(redirect('/'))
     response.delete_cookie('session_id', httponly=True, secure=True, samesite='Lax')
     return response
 
 
+# Cards changed and routes deleted by transactions that weren't finished before cursor since
+## The cursor is the oldest transaction still running, not the newest change seen, so a long
+## transaction (like an archive import) can't commit changes behind a client's cursor.
+## Changes from transactions running at the last read are sent again, which is harmless.
+def recipe_changes(user_id, since):
+    cursor = query_db("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS xmin", fetch=True)[0]['xmin']
+
+    changed = query_db(
+        "SELECT r.route, r.title, r.version, COALESCE(r.contents, c.contents) AS contents FROM recipes r LEFT JOIN canonical_recipes c ON c.id = r.canonical_id WHERE r.user_id = %s AND r.xact >= %s::text::xid8",
+        (user_id, since), fetch=True
+    )
+
+    # A fresh copy has nothing to delete, and a route that was deleted then added again is live
+    deleted = []
+    if since:
+        deleted = query_db(
+            "SELECT t.route FROM recipe_tombstones t WHERE t.user_id = %s AND t.xact >= %s::text::xid8 AND NOT EXISTS (SELECT 1 FROM recipes r WHERE r.route = t.route AND r.version > t.version)",
+            (user_id, since), fetch=True
+        )
+    return changed, [row['route'] for row in deleted], cursor
+
+
 @app.route("/cards", methods=["GET"])
 @login_required
 def cards():
-    data = query_db("SELECT contents FROM recipes WHERE user_id = %s", (get_user_id(),), fetch=True)
+    # Cards are loaded by cards.js from its local copy and /cards/delta
+    data = query_db("SELECT EXISTS (SELECT 1 FROM recipes WHERE user_id = %s) AS data", (get_user_id(),), fetch=True)
+    return render_template("cards.html", data=data[0]['data'])
+
+
+@app.route("/cards/delta", methods=["GET"])
+@login_required
+def cards_delta():
+    # Cards changed or deleted since the client's cursor
+    user_id = get_user_id()
+    since = request.args.get('since', 0, type=int)
+
+    changed, deleted, cursor = recipe_changes(user_id, since)
     recipes = []
-    for recipe in data:
+    for recipe in changed:
+        recipe['contents']['@id'] = recipe['route']
         recipes.append(recipe['contents'])
 
-    if len(recipes) < 1:
-        return render_template("cards.html", data=False)
-    return render_template("cards.html", recipes=json.dumps(recipes), data=True)
+    return jsonify({"user": user_id, "cursor": cursor, "changed": recipes, "deleted": deleted})
+
+
+@app.route('/sw.js')
+def service_worker():
+    # Served from the root so the worker can control /cards
+    return send_file('static/sw.js', mimetype='application/javascript')
 
 
 @app.route("/add-card", methods=["GET", "Post"])
 @login_required
+@concurrency_limited("add-card")
 def add_card():
     if request.method == "POST":
         # Get recipe title
@@ -427,6 +679,7 @@ def add_card():
         if image_link is None:
             file = request.files['image_upload']
             if file.filename != '':
+                limiter.take("upload-user", get_user_id())
                 # Get link of image get_image_link
                 image_link = get_image_link(file.read())
                 if image_link == None:
@@ -435,7 +688,7 @@ def add_card():
         # Add ingredients and directions to one JSON
         contents = {"ingredients": separate_content(
             ingredients, iDelimiter), "directions": separate_content(directions, dDelimiter)}
-        contents = json.dumps(contents)
+        add_parsed_ingredients(contents)
 
         # Create recipe route
         user = query_db("SELECT username FROM users where id = %s", (get_user_id(),), fetch=True)
@@ -463,7 +716,7 @@ def add_card():
             loop += 1
 
         # Add to database
-        query_db("INSERT INTO recipes (user_id, title, contents, url, image, route) VALUES (%s, %s, %s, %s, %s, %s)", (get_user_id(), title, contents, link, image_link, route), fetch=False)
+        query_db("INSERT INTO recipes (user_id, title, contents, url, image, route) VALUES (%s, %s, %s, %s, %s, %s)", (get_user_id(), title, json.dumps(contents), link, image_link, route), fetch=False)
         return redirect('/recipe/' + route)
     else:
         return render_template("add-card.html")
@@ -473,12 +726,16 @@ def add_card():
 @login_required
 def show_recipe(recipe_route):
     # Find recipe
-    recipe_data = query_db("SELECT * FROM recipes WHERE route = %s", (recipe_route,), fetch=True)
+    recipe_data = query_db(
+        "SELECT r.route, COALESCE(r.contents, c.contents) AS contents FROM recipes r LEFT JOIN canonical_recipes c ON c.id = r.canonical_id WHERE r.route = %s",
+        (recipe_route,), fetch=True
+    )
 
-    if recipe_data is None:
+    if not recipe_data:
         return apology("recipe not found", 404)
 
-    return render_template("recipe.html", recipeJSON=json.dumps(recipe_data[0]['contents']))
+    recipe_data[0]['contents']['@id'] = recipe_data[0]['route']
+    return render_template("recipe.html", recipeJSON=json.dumps(recipe_data[0]['contents']), unitsJSON=json.dumps(unit_table()))
 
 
 @app.route('/recipe/share/<recipe_route>')
@@ -486,17 +743,35 @@ def share_recipe(recipe_route):
     return apology("recipe not found", 404)
 
 
+@app.route('/recipe/<recipe_route>/similar')
+@login_required
+def similar_recipes(recipe_route):
+    return jsonify(get_ingredient_index(get_user_id()).similar(recipe_route))
+
+
+@app.route('/cook-with')
+@login_required
+def cook_with():
+    # Comma separated list of ingredients on hand
+    ingredients = request.args.get('ingredients')
+    if not ingredients:
+        return apology("must add ingredients", 400)
+
+    return jsonify(get_ingredient_index(get_user_id()).covering(separate_content(ingredients, ',')))
+
+
 @app.route("/remove-card", methods=["POST"])
 def remove_card():
     recipe_route = request.json.get('recipe_route')
 
-    query_db("DELETE FROM recipes WHERE route = %s", (recipe_route,), fetch=False)
+    delete_recipes("route = %s", (recipe_route,))
 
     return redirect("/cards")
 
 
 @app.route("/add-card-by-url", methods=["POST", "GET"])
 @login_required
+@concurrency_limited("add-card-by-url")
 def add_card_by_url():
     if request.method == "POST":
         # Get url
@@ -504,6 +779,18 @@ def add_card_by_url():
         if not url:
             return apology("must add a url", 400)
 
+        # Use the shared copy if the url was already imported
+        canonical_url = normalize_url(url)
+        canonical = get_canonical_recipe(canonical_url)
+        if canonical:
+            return add_canonical_card(canonical['id'], canonical['contents'], url)
+
+        # Limit fetches per user and per site, so one script or one slow site can't take every worker
+        site = urlparse(canonical_url).hostname or ''
+        limiter.take("import-user", get_user_id())
+        limiter.take("import-site", site)
+        limiter.acquire("import-site", site)
+
         # Get recipe content
         try:
             recipe = get_recipe_content(url, 'recipe')
@@ -517,32 +804,164 @@ def add_card_by_url():
                 return apology(error[7:], int(error[2:5]))
             else:
                 return apology(e, 500)
+        finally:
+            limiter.release("import-site", site)
 
-        # Create recipe route
-        route = recipe_route(recipe['name'])
-        # Check if already taken
-        i = query_db("SELECT * FROM recipes WHERE route = %s", (route,), fetch=True)
-        while len(i) != 0 and i[0]['route'] == route:
-            route = recipe_route(recipe['name'])
-            i = query_db("SELECT * FROM recipes WHERE route = %s", (route,), fetch=True)
-
-        recipe["@id"] = route
+        add_parsed_ingredients(recipe)
 
+        # The page may have redirected to a url that is already stored
+        final_url = normalize_url(recipe['url'])
+        canonical = get_canonical_recipe(final_url)
+        if canonical:
+            canonical_id = canonical['id']
+        else:
+            canonical_id = query_db("INSERT INTO canonical_recipes (contents) VALUES (%s) RETURNING id", (json.dumps(recipe),), fetch=True)[0]['id']
         query_db(
-            "INSERT INTO recipes (user_id, title, contents, url, route) VALUES (%s, %s, %s, %s, %s)",
-            (get_user_id(), recipe['name'], json.dumps(recipe), url, route), fetch=False
+            "INSERT INTO canonical_urls (url, recipe_id) VALUES (%s, %s), (%s, %s) ON CONFLICT (url) DO NOTHING",
+            (canonical_url, canonical_id, final_url, canonical_id), fetch=False
         )
 
-        return redirect("/recipe/" + route)
+        return add_canonical_card(canonical_id, recipe, url)
     else:
         return render_template("add-card-by-url.html")
 
 
+# Canonical recipes are shared by every card imported from the same url
+## Cards store no contents of their own until they are edited
+def get_canonical_recipe(url):
+    canonical = query_db(
+        "SELECT c.id, c.contents FROM canonical_urls u JOIN canonical_recipes c ON c.id = u.recipe_id WHERE u.url = %s",
+        (url,), fetch=True
+    )
+    if canonical:
+        return canonical[0]
+    else:
+        return None
+
+def add_canonical_card(canonical_id, contents, url):
+    title = contents['name']
+
+    # Create recipe route
+    route = recipe_route(title)
+    # Check if already taken
+    i = query_db("SELECT * FROM recipes WHERE route = %s", (route,), fetch=True)
+    while len(i) != 0 and i[0]['route'] == route:
+        route = recipe_route(title)
+        i = query_db("SELECT * FROM recipes WHERE route = %s", (route,), fetch=True)
+
+    query_db(
+        "INSERT INTO recipes (user_id, title, canonical_id, url, route) VALUES (%s, %s, %s, %s, %s)",
+        (get_user_id(), title, canonical_id, url, route), fetch=False
+    )
+    return redirect("/recipe/" + route)
+
+
+# Recipes loaded per COPY when importing an archive
+IMPORT_BATCH_SIZE = 1000
+
+# Escape a value for COPY text format
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Create routes for a batch of recipes with one lookup per round instead of one per recipe
+def allocate_routes(cur, names):
+    routes = [recipe_route(name) for name in names]
+    pending = list(range(len(routes)))
+    while pending:
+        cur.execute("SELECT route FROM recipes WHERE route = ANY(%s)", ([routes[i] for i in pending],))
+        taken = {row['route'] for row in cur.fetchall()}
+
+        # Also catch collisions within the batch
+        seen = set()
+        retry = []
+        for i in pending:
+            if routes[i] in taken or routes[i] in seen:
+                retry.append(i)
+            else:
+                seen.add(routes[i])
+        for i in retry:
+            routes[i] = recipe_route(names[i])
+        pending = retry
+    return routes
+
+# Load archive records in batches inside one transaction, yielding progress as NDJSON
+def import_recipes(records, user_id):
+    db = get_db()
+    cur = db.cursor()
+    imported = 0
+    errors = []
+    try:
+        for start in range(0, len(records), IMPORT_BATCH_SIZE):
+            batch = records[start:start + IMPORT_BATCH_SIZE]
+
+            recipes = []
+            for number, item, error in batch:
+                if error:
+                    errors.append({"record": number, "error": error})
+                    continue
+                try:
+                    recipes.append(add_parsed_ingredients(import_recipe(item)))
+                except RuntimeError as e:
+                    errors.append({"record": number, "error": str(e)})
+                except Exception:
+                    # Anything else unexpected in a record still only fails that record
+                    errors.append({"record": number, "error": "invalid recipe"})
+
+            routes = allocate_routes(cur, [recipe['name'] for recipe in recipes])
+
+            rows = io.StringIO()
+            for recipe, route in zip(recipes, routes):
+                recipe["@id"] = route
+                row = (user_id, recipe['name'], json.dumps(recipe), recipe.get('url'), route)
+                rows.write('\t'.join(copy_value(value) for value in row) + '\n')
+            rows.seek(0)
+            cur.copy_expert("COPY recipes (user_id, title, contents, url, route) FROM STDIN", rows)
+
+            imported += len(recipes)
+            yield json.dumps({"processed": start + len(batch), "total": len(records), "imported": imported}) + '\n'
+
+        db.commit()
+    except psycopg2.Error as e:
+        db.rollback()
+        yield json.dumps({"done": True, "imported": 0, "errors": errors, "failed": str(e).strip()}) + '\n'
+        return
+    finally:
+        cur.close()
+
+    yield json.dumps({"done": True, "imported": imported, "errors": errors}) + '\n'
+
+
+@app.route("/import-cards", methods=["GET", "POST"])
+@login_required
+def import_cards():
+    if request.method == "POST":
+        # Get archive
+        file = request.files.get('archive')
+        if file is None or file.filename == '':
+            return apology("must add a file", 400)
+        try:
+            text = file.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            return apology("file must be UTF-8", 400)
+
+        records = parse_recipe_archive(text)
+        if not records:
+            return apology("no recipes found", 400)
+
+        return Response(stream_with_context(import_recipes(records, get_user_id())), mimetype='application/x-ndjson')
+    else:
+        return render_template("import-cards.html")
+
+
 @app.route("/update-recipe", methods=["POST"])
 def update_recipe():
     contents = request.json.get('contents')
     if contents is None:
         return apology("no contents found", 400)
+    add_parsed_ingredients(contents)
     contents = str(contents).replace("'", '"').replace('\n', '').replace('\r', '').replace('\t', '').replace('\\', '').strip()
     route = request.json.get('recipe_route')
     if route is None:
@@ -551,34 +970,153 @@ def update_recipe():
     if title is None:
         return apology("no title found", 400)
 
-    query_db("UPDATE recipes SET title = %s, contents = %s WHERE route = %s", (title, contents, route), fetch=False)
+    # Editing a shared recipe gives the card its own copy
+    query_db(
+        "UPDATE recipes SET title = %s, contents = %s, canonical_id = NULL, version = nextval('recipe_version_seq'), xact = pg_current_xact_id(), updated_at = now() WHERE route = %s",
+        (title, contents, route), fetch=False
+    )
 
     return redirect("/recipe/" + route)
 
 
+# Dashboard statistics are shared by every admin page load for a minute
+admin_cache = TTLCache(maxsize=1, ttl=60)
+# Rows per page in the admin tables
+ADMIN_PAGE_SIZE = 50
+
+# Host of a url without www., e.g. "https://www.site.com/recipe" -> "site.com"
+URL_SITE = "substring(url from '^https?://(?:www\\.)?([^/:?#]+)')"
+
+def admin_stats():
+    stats = admin_cache.get('stats')
+    if stats is None:
+        stats = {
+            # Estimated row counts, exact counts would scan every table
+            "totals": {row['relname']: row['rows'] for row in query_db(
+                "SELECT relname, GREATEST(reltuples, 0)::bigint AS rows FROM pg_class WHERE relname IN ('users', 'recipes', 'sessions', 'errors') AND relkind = 'r'"
+            )},
+            "active_sessions": query_db("SELECT count(*) AS count FROM sessions WHERE time > now() - interval '7 days'")[0]['count'],
+            "failed_sites": query_db(
+                f"SELECT {URL_SITE} AS site, count(*) AS count FROM errors WHERE created_at > now() - interval '30 days' AND url ~ '^https?://' GROUP BY 1 ORDER BY count DESC LIMIT 20"
+            ),
+            "top_sites": query_db(
+                f"SELECT {URL_SITE} AS site, count(*) AS count FROM recipes WHERE created_at > now() - interval '30 days' AND url ~ '^https?://' GROUP BY 1 ORDER BY count DESC LIMIT 20"
+            ),
+        }
+
+        # New users and recipes per week
+        growth = {}
+        for table in ['users', 'recipes']:
+            for row in query_db(f"SELECT date_trunc('week', created_at)::date AS week, count(*) AS count FROM {table} WHERE created_at > now() - interval '12 weeks' GROUP BY 1"):
+                growth.setdefault(row['week'], {"week": row['week'], "users": 0, "recipes": 0})[table] = row['count']
+        stats['growth'] = sorted(growth.values(), key=lambda row: row['week'])
+
+        admin_cache['stats'] = stats
+    return stats
+
+
+@app.route("/admin", methods=["GET"])
+@admin_required
+def admin():
+    # Tables are paged by key so later pages cost the same as the first
+    users_after = request.args.get('users_after', 0, type=int)
+    users = query_db("SELECT id, username FROM users WHERE id > %s ORDER BY id LIMIT %s", (users_after, ADMIN_PAGE_SIZE))
+
+    # Sessions can share a time, so they're paged by (time, session_id)
+    sessions_before = request.args.get('sessions_before')
+    if sessions_before:
+        try:
+            before_time = datetime.datetime.fromisoformat(sessions_before)
+        except ValueError:
+            return apology("invalid sessions_before", 400)
+        sessions = query_db(
+            "SELECT session_id, user_id, time + interval '7 days' AS expiration, time FROM sessions WHERE (time, session_id::text) < (%s, %s) ORDER BY time DESC, session_id::text DESC LIMIT %s",
+            (before_time, request.args.get('sessions_before_id', ''), ADMIN_PAGE_SIZE)
+        )
+    else:
+        sessions = query_db("SELECT session_id, user_id, time + interval '7 days' AS expiration, time FROM sessions ORDER BY time DESC, session_id::text DESC LIMIT %s", (ADMIN_PAGE_SIZE,))
+
+    stats = admin_stats()
+    return render_template(
+        "admin.html", stats=stats, requests=stats['failed_sites'], users=users, sessions=sessions, limits=limiter.metrics(),
+        users_next=users[-1]['id'] if len(users) == ADMIN_PAGE_SIZE else None,
+        sessions_next=sessions[-1] if len(sessions) == ADMIN_PAGE_SIZE else None
+    )
+
+
+@app.route("/remove-request", methods=["POST"])
+@admin_required
+def remove_request():
+    # Forget failed imports from a site once it's been looked at
+    site = request.form.get('site')
+    if not site:
+        return apology("must provide site", 400)
+
+    query_db(f"DELETE FROM errors WHERE {URL_SITE} = %s", (site,), fetch=False)
+    admin_cache.clear()
+
+    return redirect("/admin")
+
+
 @app.route("/refresh-sessions", methods=["POST"])
+@admin_required
 def refresh_sessions():
-    sessions = query_db("SELECT * FROM sessions")
-
     current_time = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=7)
-    if sessions:
-        for session in sessions:
-            if session["time"] < current_time:
-                query_db("DELETE FROM sessions WHERE session_id = %s", (session["session_id"],), fetch=False)
+    query_db("DELETE FROM sessions WHERE time < %s", (current_time,), fetch=False)
+    admin_cache.clear()
 
-    return redirect("/")
+    return redirect("/admin")
 
 
 @app.route("/remove-user", methods=["POST"])
+@admin_required
 def remove_user():
     user_id = request.json.get('user_id')
 
     query_db("DELETE FROM users WHERE id = %s", (user_id,), fetch=False)
-    query_db("DELETE FROM recipes WHERE user_id = %s", (user_id,), fetch=False)
+    delete_recipes("user_id = %s", (user_id,))
     query_db("DELETE FROM sessions WHERE user_id = %s", (user_id,), fetch=False)
+    forget_ingredient_index(user_id)
 
     return redirect("/")
 
 
+# Recipes updated per statement when backfilling
+BACKFILL_BATCH_SIZE = 1000
+
+@app.cli.command("backfill-ingredients")
+def backfill_ingredients():
+    """Parse ingredients of recipes stored before they were parsed at ingest."""
+    db = get_db()
+    for table, key, version in [("recipes", "route", ", version = nextval('recipe_version_seq'), xact = pg_current_xact_id()"), ("canonical_recipes", "id", "")]:
+        # Server side cursor so the whole table isn't loaded at once
+        read = db.cursor(name=f"backfill_{table}")
+        # Only rows not parsed yet, so a re-run doesn't bump every card and make clients download them again
+        read.execute(f"SELECT {key} AS key, contents FROM {table} WHERE contents IS NOT NULL AND (contents->>'recipeIngredientParsed') IS NULL")
+        write = db.cursor()
+        total = 0
+        while True:
+            rows = read.fetchmany(BACKFILL_BATCH_SIZE)
+            if not rows:
+                break
+            values = [(row['key'], json.dumps(add_parsed_ingredients(row['contents']))) for row in rows if isinstance(row['contents'], dict)]
+            execute_values(
+                write,
+                f"UPDATE {table} AS t SET contents = v.contents::json{version} FROM (VALUES %s) AS v (key, contents) WHERE t.{key} = v.key",
+                values, page_size=BACKFILL_BATCH_SIZE
+            )
+            if table == "canonical_recipes" and values:
+                # Cards showing these recipes changed too, so synced clients and indexes pick them up
+                write.execute(
+                    "UPDATE recipes SET version = nextval('recipe_version_seq'), xact = pg_current_xact_id() WHERE canonical_id = ANY(%s)",
+                    ([key for key, contents in values],)
+                )
+            total += len(values)
+            print(f"{table}: {total} parsed")
+        read.close()
+        write.close()
+        db.commit()
+
+
 if __name__ == '__main__':
     app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -0,0 +1,136 @@
+import concurrent.futures
+import functools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Werkzeug hash method and work factor, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# Processes hashing passwords, 0 to hash in the request thread (e.g. serverless hosts without /dev/shm)
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+# Hashes running or waiting before new ones are turned away
+HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE", max(HASH_WORKERS, 1) * 8))
+# Seconds to wait for a place in the queue before turning a request away
+HASH_QUEUE_WAIT = 1
+# Seconds to wait for a queued hash
+HASH_TIMEOUT = 10
+
+
+class CredentialsBusy(Exception):
+    """Raised when the hashing queue is full or a hash took too long."""
+
+
+# None until first used, False when hashing inline
+pool = None
+pool_lock = threading.Lock()
+slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                pool = start_pool()
+    return pool or None
+
+
+def start_pool():
+    if HASH_WORKERS < 1:
+        return False
+    try:
+        return ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    except (OSError, ImportError, NotImplementedError):
+        # No working multiprocessing on this host -> hash inline
+        return False
+
+
+def reset_pool(broken):
+    # A worker died, start a fresh pool on next use
+    global pool
+    with pool_lock:
+        if pool is broken:
+            pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def run(function, *args):
+    # Hash in another process so slow KDFs don't hold up request threads, reject instead of queueing forever
+    if not slots.acquire(timeout=HASH_QUEUE_WAIT):
+        raise CredentialsBusy()
+
+    executor = get_pool()
+    if executor is None:
+        try:
+            return function(*args)
+        finally:
+            slots.release()
+
+    try:
+        future = executor.submit(function, *args)
+    except BrokenProcessPool:
+        slots.release()
+        reset_pool(executor)
+        raise CredentialsBusy()
+    # Keep the slot until the hash is done or cancelled, not just until this request gives up on it
+    future.add_done_callback(lambda future: slots.release())
+
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise CredentialsBusy()
+    except BrokenProcessPool:
+        reset_pool(executor)
+        raise CredentialsBusy()
+
+
+def hash_password(password):
+    return run(generate_password_hash, password, HASH_METHOD)
+
+
+def verify_password(hash, password):
+    return run(check_password_hash, hash, password)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_prefix():
+    # Werkzeug fills in default parameters, so read them back from a real hash
+    return generate_password_hash("", HASH_METHOD).split("$")[0]
+
+
+def needs_rehash(hash):
+    # True if hash was made with a different method or work factor than the current one
+    return hash.split("$")[0] != hash_prefix()
+
+
+if __name__ == '__main__':
+    # Benchmark: python credentials.py [logins] [cheap requests] [request threads]
+    # Simulates a login storm mixed with cheap requests on one worker, hashing inline vs in the pool
+    import sys
+    from loadtest import percentile, run_mix
+
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cheap = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    stored = generate_password_hash("password", HASH_METHOD)
+
+    def bench(label, verify):
+        def login():
+            try:
+                verify(stored, "password")
+                return "ok"
+            except CredentialsBusy:
+                return "503"
+
+        elapsed, outcomes, times = run_mix({"login": login, "cheap": lambda: sum(range(2000)) and "ok"}, {"login": logins, "cheap": cheap}, threads)
+        print(f"{label}: {elapsed:.2f}s, logins ok {outcomes['login']['ok']} / 503 {outcomes['login']['503']} ({outcomes['login']['ok'] / elapsed:.1f}/s), "
+              f"login p99 {percentile(times['login'], 0.99):.0f}ms, cheap p50 {percentile(times['cheap'], 0.5):.0f}ms p99 {percentile(times['cheap'], 0.99):.0f}ms")
+
+    get_pool().submit(hash_prefix).result()
+    bench("inline", check_password_hash)
+    bench("pool", verify_password)
+    pool.shutdown()
@@ -10,7 +10,7 @@ from bs4 import BeautifulSoup
 from flask import render_template
 from google import genai
 from google.genai import types
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 from w3lib.html import get_base_url
 
 
@@ -71,6 +71,26 @@ def recipe_route(title):
     return title + '-' + uuid.uuid4().hex[:6]
 
 
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid", "ref", "ref_src", "_ga", "si"}
+
+def normalize_url(url):
+    # Reduce a recipe url to one form so the same page is only scraped once
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parsed.port and parsed.port not in (80, 443):
+        host += f':{parsed.port}'
+    path = parsed.path.rstrip('/') or '/'
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                   if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS)
+    return urlunparse((scheme, host, path, '', urlencode(query), ''))
+
+
 def sanitize_text(value):
     if not isinstance(value, str):
         return value
@@ -191,7 +211,7 @@ Ingredients:
     return total
 
 
-def format_json(json, url, site):
+def format_json(json, url, site, fetch_image=True):
     jsonFields = ["name", "description", "author", "image", "totalTime", "prepTime", "cookTime", "recipeYield", "recipeCategory", "recipeCuisine", "keywords", "aggregateRating", "recipeIngredient", "recipeInstructions", "publisher", "copyrightHolder"]
 
     final = {}
@@ -205,7 +225,7 @@ def format_json(json, url, site):
         final['publisher'] = {}
         final['publisher']['name'] = site
 
-    if not final.get('image'):
+    if not final.get('image') and fetch_image:
         try:
             image = get_recipe_content(url, 'image')
         except RuntimeError:
@@ -221,7 +241,7 @@ def get_recipe_content(url, fetch_type):
     headers = {"Cache-Control":"max-age=0","Upgrade-Insecure-Requests":"1","User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36","Accept":"text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7","Sec-Fetch-Site":"same-origin","Sec-Fetch-Mode":"navigate","Sec-Fetch-User":"?1","Sec-Fetch-Dest":"document","Accept-Encoding":"gzip, deflate","Accept-Language":"en-US,en;q=0.9"}
     # Get website HTML
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=10)
     except requests.exceptions.MissingSchema:
         raise RuntimeError("[[400]]Invalid URL format (missing http/https)")
     except requests.exceptions.InvalidURL:
@@ -252,15 +272,10 @@ def get_recipe_content(url, fetch_type):
                     parsed_url = urlparse(response.url)
                     site = parsed_url.netloc.replace('www.', '').split('.')[0].capitalize()
 
-                item_type = item.get('@type')
                 # Check if recipe  ---  Sometimes wrapped in an @graph
-                if "@graph" in item:
-                    for sub_item in item["@graph"]:
-                        sub_item_type = sub_item.get('@type')
-                        if sub_item_type == 'Recipe' or (isinstance(sub_item_type, list) and 'Recipe' in sub_item_type):
-                            return format_json(sub_item, url, site)
-                elif item_type == 'Recipe' or (isinstance(item_type, list) and 'Recipe' in item_type):
-                    return format_json(item, url, site)
+                # Use the url after redirects so it can be matched to the canonical recipe
+                for recipe in find_recipes(item):
+                    return format_json(recipe, response.url, site)
         """ else:
             for item in data.get('json-ld', []):
                 image = item.get('image')
@@ -269,4 +284,89 @@ def get_recipe_content(url, fetch_type):
             raise RuntimeError("No Image") """
     else:
         raise RuntimeError(f"Connection unsuccessful: {response.status_code}")
-    raise RuntimeError("No recipe found")
\ No newline at end of file
+    raise RuntimeError("No recipe found")
+
+
+def is_recipe(item):
+    if not isinstance(item, dict):
+        return False
+    item_type = item.get('@type')
+    return item_type == 'Recipe' or (isinstance(item_type, list) and 'Recipe' in item_type)
+
+
+def find_recipes(item):
+    # Recipes can be top level or wrapped in an @graph
+    if isinstance(item, dict) and "@graph" in item:
+        return [sub_item for sub_item in item["@graph"] if is_recipe(sub_item)]
+    elif is_recipe(item):
+        return [item]
+    return []
+
+
+def parse_recipe_archive(text):
+    """
+    Read a recipe archive, either a JSON-LD document (single object, list or @graph)
+    or an NDJSON export with one object per line.
+
+    Returns a list of (record number, recipe, error) tuples, where recipe is None and
+    error is the message if the record could not be read.
+    """
+    try:
+        data = json.loads(text)
+        items = [(item, None) for item in (data if isinstance(data, list) else [data])]
+    except json.JSONDecodeError:
+        items = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except json.JSONDecodeError:
+                items.append((None, "invalid JSON"))
+
+    records = []
+    for number, (item, error) in enumerate(items, 1):
+        if error:
+            records.append((number, None, error))
+            continue
+        recipes = find_recipes(item)
+        if not recipes:
+            records.append((number, None, "no recipe found"))
+        for recipe in recipes:
+            records.append((number, recipe, None))
+    return records
+
+
+def import_recipe(item):
+    # Validate and normalize an archived recipe the same way as a scraped one
+    name = sanitize_text(item.get('name'))
+    if not name or not isinstance(name, str):
+        raise RuntimeError("missing name")
+    ingredients = item.get('recipeIngredient')
+    if isinstance(ingredients, str):
+        ingredients = [ingredients]
+    if not ingredients:
+        raise RuntimeError("missing ingredients")
+    if not isinstance(ingredients, list) or not all(isinstance(ingredient, str) for ingredient in ingredients):
+        raise RuntimeError("ingredients must be a list of strings")
+    item = {**item, 'recipeIngredient': ingredients}
+    if not item.get('recipeInstructions'):
+        raise RuntimeError("missing directions")
+
+    url = item.get('url') or item.get('mainEntityOfPage')
+    if isinstance(url, dict):
+        url = url.get('@id')
+    if not isinstance(url, str):
+        url = None
+
+    publisher = item.get('publisher')
+    if isinstance(publisher, dict) and publisher.get('name'):
+        site = publisher['name']
+    elif url:
+        site = urlparse(url).netloc.replace('www.', '').split('.')[0].capitalize()
+    else:
+        site = 'Imported'
+
+    # Don't fetch missing images, an archive can hold thousands of recipes
+    return format_json(item, url, site, fetch_image=False)
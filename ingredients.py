@@ -0,0 +1,333 @@
+import functools
+import heapq
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+
+# Words that describe an ingredient without changing what it is
+DESCRIPTORS = {
+    "a", "an", "and", "or", "of", "to", "for", "the", "about", "plus", "taste", "needed", "optional", "divided",
+    "fresh", "freshly", "dried", "large", "medium", "small", "extra", "whole", "raw", "ripe",
+    "chopped", "diced", "minced", "sliced", "grated", "shredded", "crushed", "ground", "peeled",
+    "finely", "roughly", "coarsely", "thinly", "lightly", "packed", "softened", "melted", "beaten",
+    "cold", "warm", "hot", "room", "temperature", "boneless", "skinless", "cubed", "halved", "quartered",
+}
+
+
+def singular(word):
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith(('oes', 'ches', 'shes', 'xes')):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')) and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def normalize_ingredient(line):
+    # Reduce an ingredient line to the name of the ingredient, e.g. "2 cups chopped onions" -> "onion"
+    if not isinstance(line, str):
+        return ''
+    # The parser drops the quantity, the unit right after it and notes, so "cloves" in "1 tsp ground cloves" stays
+    text = parse_ingredient(line)['name']
+    # "a pinch of salt" -> "salt", the article is the quantity
+    article = re.match(r"an?\s+(\S+?)\.?\s+(?:of\s+)?(.+)", text, re.IGNORECASE)
+    if article and article.group(1).lower() in UNIT_NAMES:
+        text = article.group(2)
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+    # Drop leftover numbers and punctuation
+    text = re.sub(r'[^a-z\s]', ' ', text)
+    words = [singular(word) for word in text.split() if word not in DESCRIPTORS]
+    return ' '.join(words)
+
+
+# Unit -> (dimension, size in ml or g), alternate spellings map to the first name
+UNIT_SIZES = {
+    "tsp": ("volume", 4.92892, ["teaspoon", "teaspoons", "tsps", "t"]),
+    "tbsp": ("volume", 14.7868, ["tablespoon", "tablespoons", "tbsps", "tbs", "tb", "T"]),
+    "cup": ("volume", 236.588, ["cups", "c"]),
+    "fl oz": ("volume", 29.5735, ["fluid ounce", "fluid ounces", "fl. oz", "fl oz."]),
+    "pint": ("volume", 473.176, ["pints", "pt"]),
+    "quart": ("volume", 946.353, ["quarts", "qt"]),
+    "gallon": ("volume", 3785.41, ["gallons", "gal"]),
+    "ml": ("volume", 1, ["milliliter", "milliliters", "millilitre", "millilitres"]),
+    "l": ("volume", 1000, ["liter", "liters", "litre", "litres"]),
+    "oz": ("weight", 28.3495, ["ounce", "ounces"]),
+    "lb": ("weight", 453.592, ["pound", "pounds", "lbs"]),
+    "g": ("weight", 1, ["gram", "grams", "gr"]),
+    "kg": ("weight", 1000, ["kilogram", "kilograms", "kgs"]),
+    "pinch": ("count", 1, ["pinches"]),
+    "dash": ("count", 1, ["dashes"]),
+    "clove": ("count", 1, ["cloves"]),
+    "can": ("count", 1, ["cans"]),
+    "package": ("count", 1, ["packages", "pkg"]),
+    "stick": ("count", 1, ["sticks"]),
+    "slice": ("count", 1, ["slices"]),
+    "sprig": ("count", 1, ["sprigs"]),
+    "bunch": ("count", 1, ["bunches"]),
+    "handful": ("count", 1, ["handfuls"]),
+    "jar": ("count", 1, ["jars"]),
+    "head": ("count", 1, ["heads"]),
+    "piece": ("count", 1, ["pieces"]),
+    "inch": ("count", 1, ["inches"]),
+}
+
+UNIT_NAMES = {}
+for unit, (dimension, size, aliases) in UNIT_SIZES.items():
+    for alias in [unit] + aliases:
+        UNIT_NAMES[alias if alias in ("t", "T") else alias.lower()] = unit
+
+# Units each measuring system converts volumes and weights to, smallest first
+UNIT_SYSTEMS = {
+    "metric": {"volume": ["ml", "l"], "weight": ["g", "kg"]},
+    "us": {"volume": ["tsp", "tbsp", "cup"], "weight": ["oz", "lb"]},
+}
+
+FRACTIONS = {"½": 1 / 2, "⅓": 1 / 3, "⅔": 2 / 3, "¼": 1 / 4, "¾": 3 / 4, "⅕": 1 / 5, "⅖": 2 / 5, "⅗": 3 / 5, "⅘": 4 / 5, "⅙": 1 / 6, "⅚": 5 / 6, "⅛": 1 / 8, "⅜": 3 / 8, "⅝": 5 / 8, "⅞": 7 / 8}
+
+NUMBER = r"(?:\d+(?:\s+|\s*-\s*)\d+\s*/\s*\d+|\d+\s*/\s*\d+|\d+\s*[{f}]|\d*\.\d+|\d+|[{f}])".format(f="".join(FRACTIONS))
+UNIT = "|".join(re.escape(name) for name in sorted(UNIT_NAMES, key=len, reverse=True))
+INGREDIENT = re.compile(
+    r"^\s*(?P<quantity>{n})(?:\s*(?:-|–|to|or)\s*(?P<max>{n}))?\s*(?:(?P<unit>{u})\.?(?![a-zA-Z]))?\s*(?:of\s+)?(?P<name>.*)$".format(n=NUMBER, u=UNIT),
+    re.IGNORECASE
+)
+
+
+def parse_number(text):
+    # "1 1/2", "1-1/2", "1/2", "1½", "½", "1.5", None for a zero denominator
+    mixed = re.match(r"(\d+)(?:\s+|\s*-\s*)(\d+)\s*/\s*(\d+)$", text)
+    if mixed:
+        whole, numerator, denominator = (int(group) for group in mixed.groups())
+        return whole + numerator / denominator if denominator else None
+    text = text.replace(" ", "")
+    if text[-1] in FRACTIONS:
+        return (int(text[:-1]) if text[:-1] else 0) + FRACTIONS[text[-1]]
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return int(numerator) / int(denominator) if int(denominator) else None
+    return float(text)
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_ingredient(line):
+    text = re.sub(r"\s+", " ", line).strip()
+    parsed = {"raw": line}
+
+    # Notes in parentheses or after a comma, e.g. "2 onions (about 1 lb), diced"
+    notes = re.findall(r"\(([^)]*)\)", text)
+    text = re.sub(r"\s*\([^)]*\)", "", text)
+    if "," in text:
+        text, rest = text.split(",", 1)
+        notes.append(rest.strip())
+
+    match = INGREDIENT.match(text)
+    if match:
+        quantity = parse_number(match.group("quantity"))
+        if quantity is not None:
+            parsed["quantity"] = round(quantity, 3)
+            # Only a larger second number is a range, e.g. "2-3", not "3-2"
+            maximum = parse_number(match.group("max")) if match.group("max") else None
+            if maximum is not None and maximum > quantity:
+                parsed["max"] = round(maximum, 3)
+        if match.group("unit"):
+            unit = match.group("unit")
+            parsed["unit"] = UNIT_NAMES.get(unit if unit in ("t", "T") else unit.lower().rstrip("."))
+        text = match.group("name")
+
+    parsed["name"] = text.strip()
+    notes = [note for note in notes if note]
+    if notes:
+        parsed["notes"] = "; ".join(notes)
+    return tuple(parsed.items())
+
+
+def parse_ingredient(line):
+    """
+    Split an ingredient line into quantity, max (for ranges), unit, name and notes.
+
+    Keys without a value are left out. Lines are cached since the same ones repeat across recipes.
+    """
+    if not isinstance(line, str):
+        return {"raw": line, "name": str(line)}
+    return dict(_parse_ingredient(line))
+
+
+def unit_table():
+    # Sizes of the convertible units and the units of each system, for converting in the recipe view
+    sizes = {unit: [dimension, size] for unit, (dimension, size, aliases) in UNIT_SIZES.items() if dimension != "count"}
+    return {"sizes": sizes, "systems": UNIT_SYSTEMS}
+
+
+def add_parsed_ingredients(contents):
+    # Store the parsed ingredients alongside the raw lines so views don't parse them again
+    if isinstance(contents, dict):
+        contents['recipeIngredientParsed'] = [parse_ingredient(line) for line in recipe_ingredients(contents)]
+    return contents
+
+
+def ingredient_names(contents):
+    # Ingredient names from the parsed lines when the card has them, the raw lines otherwise
+    parsed = contents.get('recipeIngredientParsed') if isinstance(contents, dict) else None
+    if parsed:
+        return [item.get('name', '') for item in parsed if isinstance(item, dict)]
+    return recipe_ingredients(contents)
+
+
+def recipe_ingredients(contents):
+    # Scraped recipes use recipeIngredient, manually added cards use ingredients
+    if not isinstance(contents, dict):
+        return []
+    ingredients = contents.get('recipeIngredient') or contents.get('ingredients') or []
+    if isinstance(ingredients, str):
+        ingredients = [ingredients]
+    return ingredients
+
+
+class IngredientIndex:
+    """
+    Inverted index from normalized ingredient names to recipes.
+
+    Recipes are added, replaced and removed one at a time so the index can be kept
+    up to date as cards change instead of being rebuilt. cursor is the position in
+    the change feed the index has caught up to, held by whoever holds refreshing.
+    """
+
+    # Ingredients in more than this share of recipes (salt, water...) aren't used to find candidates
+    COMMON = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.vocabulary = {}
+        self.words = []
+        self.recipes = {}
+        self.names = {}
+        self.postings = defaultdict(set)
+        self.cursor = 0
+        self.refreshing = threading.Lock()
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def ingredient_ids(self, ingredients, create=False):
+        ids = set()
+        for ingredient in ingredients:
+            word = normalize_ingredient(ingredient)
+            if not word:
+                continue
+            if word not in self.vocabulary:
+                if not create:
+                    continue
+                self.vocabulary[word] = len(self.words)
+                self.words.append(word)
+            ids.add(self.vocabulary[word])
+        return frozenset(ids)
+
+    def add(self, route, name, ingredients):
+        with self.lock:
+            self._add(route, name, ingredients)
+
+    def _add(self, route, name, ingredients):
+        self._remove(route)
+        ids = self.ingredient_ids(ingredients, create=True)
+        self.recipes[route] = ids
+        self.names[route] = name
+        for i in ids:
+            self.postings[i].add(route)
+
+    def remove(self, route):
+        with self.lock:
+            self._remove(route)
+
+    def update(self, changed, deleted, cursor):
+        # Apply (route, name, ingredients) changes and deleted routes from the change feed
+        with self.lock:
+            for route in deleted:
+                self._remove(route)
+            for route, name, ingredients in changed:
+                self._add(route, name, ingredients)
+            self.cursor = cursor
+
+    def _remove(self, route):
+        ids = self.recipes.pop(route, None)
+        self.names.pop(route, None)
+        if ids is None:
+            return
+        for i in ids:
+            self.postings[i].discard(route)
+
+    def candidates(self, ids):
+        # Count shared ingredients per recipe, skipping very common ingredients if there are rarer ones
+        limit = max(1000, int(len(self.recipes) * self.COMMON))
+        lists = sorted((self.postings[i] for i in ids), key=len)
+        rare = [routes for routes in lists if len(routes) <= limit] or lists
+        counts = defaultdict(int)
+        for routes in rare:
+            for route in routes:
+                counts[route] += 1
+        return counts
+
+    def similar(self, route, limit=10):
+        """Recipes sharing the most ingredients with route, ranked by Jaccard similarity."""
+        with self.lock:
+            ids = self.recipes.get(route)
+            if not ids:
+                return []
+            results = []
+            for other in self.candidates(ids):
+                if other == route:
+                    continue
+                other_ids = self.recipes[other]
+                shared = len(ids & other_ids)
+                results.append((shared / (len(ids) + len(other_ids) - shared), other))
+            return [{"route": other, "name": self.names[other], "score": round(score, 3)} for score, other in heapq.nlargest(limit, results)]
+
+    def covering(self, ingredients, limit=10):
+        """Recipes that can be made with the most of ingredients, fewest missing ingredients first."""
+        with self.lock:
+            have = self.ingredient_ids(ingredients)
+            if not have:
+                return []
+            results = []
+            for route in self.candidates(have):
+                ids = self.recipes[route]
+                shared = len(ids & have)
+                results.append((len(ids) - shared, -shared, route))
+            return [
+                {"route": route, "name": self.names[route], "score": round(-shared / len(self.recipes[route]), 3), "missing": sorted(self.words[i] for i in self.recipes[route] - have)}
+                for missing, shared, route in heapq.nsmallest(limit, results)
+            ]
+
+
+if __name__ == '__main__':
+    # Benchmark: python ingredients.py [recipes]
+    import random
+    import sys
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(0)
+    pantry = ["salt", "water", "olive oil", "butter", "sugar", "flour", "egg", "milk", "garlic", "onion"]
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    rare = [letters[i // 676] + letters[i // 26 % 26] + letters[i % 26] + "root" for i in range(5000)]
+
+    index = IngredientIndex()
+    start = time.perf_counter()
+    for n in range(count):
+        lines = random.sample(pantry, 4) + random.sample(rare, random.randint(3, 10))
+        index.add(f"recipe-{n}", f"Recipe {n}", [f"2 cups chopped {line}" for line in lines])
+    print(f"indexed {count} recipes in {time.perf_counter() - start:.2f}s")
+
+    def timed(label, runs, query):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            query()
+            times.append(time.perf_counter() - start)
+        times.sort()
+        print(f"{label}: median {1000 * times[len(times) // 2]:.2f}ms, p99 {1000 * times[int(len(times) * 0.99)]:.2f}ms")
+
+    timed("similar", 200, lambda: index.similar(f"recipe-{random.randrange(count)}"))
+    timed("covering", 200, lambda: index.covering(random.sample(pantry, 3) + random.sample(rare, 5)))
+    timed("update", 2000, lambda: index.add(f"recipe-{random.randrange(count)}", "Updated", random.sample(rare, 6)))
@@ -0,0 +1,109 @@
+import random
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, p):
+    # Milliseconds at fraction p of the sorted seconds in values
+    if not values:
+        return 0
+    values = sorted(values)
+    return 1000 * values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_mix(handlers, counts, threads, seed=0):
+    """
+    Call each handler counts[kind] times, shuffled together, from threads request threads.
+
+    Handlers return an outcome (e.g. a status code). Returns the seconds taken, a Counter of
+    outcomes per kind and the seconds each call took from being queued, per kind.
+    """
+    kinds = [kind for kind, count in counts.items() for _ in range(count)]
+    random.Random(seed).shuffle(kinds)
+    outcomes = defaultdict(Counter)
+    times = defaultdict(list)
+
+    def call(kind, queued):
+        outcomes[kind][handlers[kind]()] += 1
+        times[kind].append(time.perf_counter() - queued)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for kind in kinds:
+            executor.submit(call, kind, time.perf_counter())
+    return time.perf_counter() - start, outcomes, times
+
+
+if __name__ == '__main__':
+    # Load test: python loadtest.py [imports] [cheap requests] [request threads]
+    # Drives POST /add-card-by-url against slow sites mixed with GET /cards through the Flask test client,
+    # with the app's limits and with them lifted. Only the outbound fetch is stubbed, so DATABASE_URL must
+    # point at a scratch database with the app's schema.
+    import sys
+    import uuid
+    import app as recipe_app
+    from ratelimit import RateLimiter
+
+    imports = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    cheap = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    def slow_fetch(url, type):
+        # A site that takes 200ms to answer
+        time.sleep(0.2)
+        return {"@type": "Recipe", "name": "Load test", "url": url, "recipeIngredient": ["1 cup flour", "2 eggs"]}
+
+    recipe_app.get_recipe_content = slow_fetch
+
+    # Throwaway user with a session the test client can send
+    username = f"loadtest-{uuid.uuid4()}"
+    session_id = str(uuid.uuid4())
+    with recipe_app.app.app_context():
+        recipe_app.query_db("INSERT INTO users (username, hash) VALUES (%s, %s)", (username, "-"), fetch=False)
+        user_id = recipe_app.query_db("SELECT id FROM users WHERE username = %s", (username,))[0]['id']
+        recipe_app.query_db(
+            "INSERT INTO sessions (session_id, user_id, ip, user_agent, time) VALUES (%s, %s, %s, %s, now())",
+            (session_id, user_id, "127.0.0.1", "loadtest"), fetch=False
+        )
+
+    client = recipe_app.app.test_client(use_cookies=False)
+    headers = {"Cookie": f"session_id={session_id}", "User-Agent": "loadtest"}
+    urls = iter(range(10 ** 9))
+
+    def add_card():
+        # New url every time so each request fetches, spread over a few sites
+        n = next(urls)
+        response = client.post("/add-card-by-url", data={"url": f"https://load-test-{n % 4}.example/recipe/{n}"}, headers=headers)
+        return response.status_code
+
+    def cards():
+        return client.get("/cards", headers=headers).status_code
+
+    def bench(label, limiter):
+        recipe_app.limiter = limiter
+        elapsed, outcomes, times = run_mix({"import": add_card, "cards": cards}, {"import": imports, "cards": cheap}, threads)
+        print(f"{label}: {elapsed:.2f}s, imports {dict(outcomes['import'])}, /cards {dict(outcomes['cards'])} "
+              f"p50 {percentile(times['cards'], 0.5):.0f}ms p99 {percentile(times['cards'], 0.99):.0f}ms")
+
+    limited = recipe_app.limiter
+    try:
+        unlimited = RateLimiter()
+        for name in ("import-user", "import-site", "upload-user"):
+            unlimited.limit(name, 10 ** 9, 1)
+        for name in ("add-card-by-url", "add-card", "import-site"):
+            unlimited.cap(name, 10 ** 9)
+        bench("no limits", unlimited)
+
+        bench("app limits", limited)
+        print(f"  metrics: {limited.metrics()}")
+    finally:
+        with recipe_app.app.app_context():
+            recipe_app.query_db("DELETE FROM recipes WHERE user_id = %s", (user_id,), fetch=False)
+            recipe_app.query_db("DELETE FROM recipe_tombstones WHERE user_id = %s", (user_id,), fetch=False)
+            recipe_app.query_db(
+                "WITH urls AS (DELETE FROM canonical_urls WHERE url LIKE 'https://load-test-%%.example/%%' RETURNING recipe_id) DELETE FROM canonical_recipes WHERE id IN (SELECT recipe_id FROM urls)",
+                fetch=False
+            )
+            recipe_app.query_db("DELETE FROM sessions WHERE user_id = %s", (user_id,), fetch=False)
+            recipe_app.query_db("DELETE FROM users WHERE id = %s", (user_id,), fetch=False)
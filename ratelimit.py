@@ -0,0 +1,156 @@
+import threading
+import time
+from cachetools import TTLCache
+from collections import Counter
+
+
+class Throttled(Exception):
+    """Raised when a request is over a rate or concurrency limit."""
+
+    def __init__(self, name, retry_after, status=429):
+        super().__init__(name)
+        self.name = name
+        self.retry_after = retry_after
+        self.status = status
+
+
+class MemoryBackend:
+    """
+    Token buckets kept in this process.
+
+    Buckets untouched for ttl seconds are dropped, which loses nothing once ttl is at least the
+    longest refill time since they'd be full again. At most maxsize buckets are kept, so keys from
+    user input (like site hostnames) can't grow memory without bound.
+    """
+
+    def __init__(self, maxsize=100000, ttl=3600):
+        self.lock = threading.Lock()
+        self.buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def take(self, key, capacity, rate, cost=1):
+        # Returns 0 if the tokens were taken, otherwise seconds until there will be enough
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+
+class PostgresBackend:
+    """
+    Token buckets shared by every process through Postgres.
+
+    Each thread has its own connection, and a statement taking longer than timeout seconds is
+    cancelled (RateLimiter lets the request through).
+
+    Requires:
+        CREATE TABLE rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated TIMESTAMPTZ NOT NULL);
+    """
+
+    # Refill the bucket by the database clock so every process agrees
+    LEVEL = "LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated) * %(rate)s)"
+    # Take the tokens in one statement, no row comes back if there weren't enough
+    TAKE = (
+        "INSERT INTO rate_limits AS b (key, tokens, updated) VALUES (%(key)s, %(capacity)s - %(cost)s, now()) "
+        f"ON CONFLICT (key) DO UPDATE SET tokens = {LEVEL} - %(cost)s, updated = now() WHERE {LEVEL} >= %(cost)s "
+        "RETURNING tokens"
+    )
+    WAIT = f"SELECT (%(cost)s - {LEVEL}) / %(rate)s FROM rate_limits AS b WHERE key = %(key)s"
+
+    def __init__(self, connect, timeout=0.5):
+        self.connect = connect
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or db.closed:
+            db = self.local.db = self.connect()
+            db.autocommit = True
+            cur = db.cursor()
+            cur.execute("SET statement_timeout = %s", (int(self.timeout * 1000),))
+            cur.close()
+        return db
+
+    def take(self, key, capacity, rate, cost=1):
+        db = self.connection()
+        args = {"key": key, "capacity": capacity, "rate": rate, "cost": cost}
+        try:
+            cur = db.cursor()
+            cur.execute(self.TAKE, args)
+            if cur.fetchone():
+                cur.close()
+                return 0
+            cur.execute(self.WAIT, args)
+            row = cur.fetchone()
+            cur.close()
+            # Refilled since the take -> try again right away
+            return max(float(row[0]), 0.001) if row else 0.001
+        except Exception:
+            db.close()
+            raise
+
+
+class RateLimiter:
+    """Named token bucket limits and concurrency caps, with counts of allowed and throttled requests."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.limits = {}
+        self.caps = {}
+        self.active = Counter()
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def limit(self, name, capacity, per):
+        # Allow bursts of capacity requests, refilling capacity tokens every per seconds
+        self.limits[name] = (capacity, capacity / per)
+
+    def cap(self, name, concurrent, retry_after=1):
+        self.caps[name] = (concurrent, retry_after)
+
+    def take(self, name, key, cost=1):
+        capacity, rate = self.limits[name]
+        try:
+            retry_after = self.backend.take(f"{name}:{key}", capacity, rate, cost)
+        except Exception:
+            # Don't turn a broken shared backend into an outage
+            self.count(name, "error")
+            return
+        if retry_after:
+            self.count(name, "throttled")
+            raise Throttled(name, retry_after)
+        self.count(name, "allowed")
+
+    def acquire(self, name, key=""):
+        # Take one of a cap's slots without waiting, call release when done
+        concurrent, retry_after = self.caps[name]
+        with self.lock:
+            if self.active[(name, key)] >= concurrent:
+                self.counts[(name, "shed")] += 1
+                raise Throttled(name, retry_after, status=503)
+            self.active[(name, key)] += 1
+            self.counts[(name, "allowed")] += 1
+
+    def release(self, name, key=""):
+        with self.lock:
+            self.active[(name, key)] -= 1
+            if not self.active[(name, key)]:
+                del self.active[(name, key)]
+
+    def count(self, name, outcome):
+        with self.lock:
+            self.counts[(name, outcome)] += 1
+
+    def metrics(self):
+        rows = {}
+        with self.lock:
+            counts = list(self.counts.items())
+        for (name, outcome), count in counts:
+            rows.setdefault(name, {"name": name, "allowed": 0, "throttled": 0, "shed": 0, "error": 0})[outcome] = count
+        return sorted(rows.values(), key=lambda row: row['name'])
+
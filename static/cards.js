@@ -100,9 +100,108 @@ function remove_card(event) {
 
 
 
+// Offline cache
+// Cards are kept in IndexedDB and only changes since the last visit are fetched
+function openCardStore() {
+  return new Promise((resolve, reject) => {
+    const request = indexedDB.open('recipe-cards', 2);
+    request.onupgradeneeded = event => {
+      if (event.oldVersion < 1) {
+        request.result.createObjectStore('cards', { keyPath: '@id' });
+        request.result.createObjectStore('meta');
+      } else {
+        // Cursors from version 1 were card versions, not transaction ids -> start over
+        request.transaction.objectStore('cards').clear();
+        request.transaction.objectStore('meta').clear();
+      }
+    };
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+function storeRequest(request) {
+  return new Promise((resolve, reject) => {
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+async function readCache(db) {
+  const tx = db.transaction(['cards', 'meta']);
+  const [cards, cursor, user] = await Promise.all([
+    storeRequest(tx.objectStore('cards').getAll()),
+    storeRequest(tx.objectStore('meta').get('cursor')),
+    storeRequest(tx.objectStore('meta').get('user'))
+  ]);
+  return { cards: cards, cursor: cursor || 0, user: user };
+}
+
+function writeCache(db, delta, reset) {
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(['cards', 'meta'], 'readwrite');
+    const cards = tx.objectStore('cards');
+    if (reset) cards.clear();
+    delta['deleted'].forEach(route => cards.delete(route));
+    delta['changed'].forEach(card => cards.put(card));
+    tx.objectStore('meta').put(delta['cursor'], 'cursor');
+    tx.objectStore('meta').put(delta['user'], 'user');
+    tx.oncomplete = resolve;
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+async function fetchDelta(since) {
+  const response = await fetch(`/cards/delta?since=${since}`);
+  if (!response.ok) throw new Error(response.status);
+  return response.json();
+}
+
+async function syncCards() {
+  let db = null;
+  let cache = { cards: [], cursor: 0, user: null };
+  try {
+    db = await openCardStore();
+    cache = await readCache(db);
+  } catch (e) {
+    db = null;
+  }
+
+  let delta;
+  let reset = false;
+  try {
+    delta = await fetchDelta(cache.cursor);
+    // Another user logged in on this browser -> start over
+    if (cache.user != null && cache.user !== delta['user']) {
+      reset = true;
+      cache.cards = [];
+      delta = await fetchDelta(0);
+    }
+  } catch (e) {
+    // Offline -> show the saved copy
+    return cache.cards;
+  }
+
+  if (db) {
+    await writeCache(db, delta, reset).catch(() => {});
+  }
+
+  const cards = new Map(cache.cards.map(card => [card['@id'], card]));
+  delta['deleted'].forEach(route => cards.delete(route));
+  delta['changed'].forEach(card => cards.set(card['@id'], card));
+  return Array.from(cards.values());
+}
+
+if ('serviceWorker' in navigator) {
+  navigator.serviceWorker.register('/sw.js');
+}
+
+
 // Initial load
-document.addEventListener('DOMContentLoaded', function() {
-  const recipes = JSON.parse(`${document.getElementById('data').innerText}`);
+document.addEventListener('DOMContentLoaded', async function() {
+  if (!document.getElementById('card-container')) return;
+
+  const recipes = await syncCards();
   renderCards(recipes);
 
   // Search
@@ -127,6 +226,15 @@ document.addEventListener('DOMContentLoaded', function() {
     const query = searchInput.value.trim();
     if (query === '') {
       renderCards(recipes);
+    } else if (query.includes(',')) {
+      // Comma separated ingredients -> recipes you can make with them
+      fetch('/cook-with?ingredients=' + encodeURIComponent(query))
+      .then(response => response.ok ? response.json() : [])
+      .then(results => {
+        if (searchInput.value.trim() !== query) return;
+        const byRoute = new Map(recipes.map(recipe => [recipe['@id'], recipe]));
+        renderCards(results.map(result => byRoute.get(result.route)).filter(recipe => recipe), query);
+      });
     } else {
       const results = fuse.search(query);
       renderCards(results.map(result => result.item), query);
@@ -36,6 +36,71 @@ function timeConvert(time) {
 
 
 
+const FRACTIONS = [[1 / 8, '⅛'], [1 / 4, '¼'], [1 / 3, '⅓'], [3 / 8, '⅜'], [1 / 2, '½'], [5 / 8, '⅝'], [2 / 3, '⅔'], [3 / 4, '¾'], [7 / 8, '⅞']];
+
+function formatQuantity(quantity, decimal) {
+    // Metric amounts read as decimals, e.g. 473 ml or 1.4 l
+    if (decimal) {
+        return `${parseFloat(quantity.toFixed(quantity >= 10 ? 0 : 1))}`;
+    }
+    let whole = Math.floor(quantity);
+    let rest = quantity - whole;
+    if (rest < 0.06) {
+        return `${whole}`;
+    }
+    if (rest > 0.94) {
+        return `${whole + 1}`;
+    }
+    // Closest common fraction
+    const fraction = FRACTIONS.reduce((best, f) => Math.abs(f[0] - rest) < Math.abs(best[0] - rest) ? f : best);
+    return whole > 0 ? `${whole}${fraction[1]}` : fraction[1];
+}
+
+// Multiplier and unit to show a quantity in a measuring system (metric or us), null to keep the unit
+function convertUnit(quantity, unit, units, system) {
+    const size = units['sizes'][unit];
+    if (!system || !size) {
+        return null;
+    }
+    // Largest unit of the system that keeps the quantity at 1 or more
+    const targets = units['systems'][system][size[0]];
+    let target = targets[0];
+    targets.forEach(t => {
+        if (quantity * size[1] / units['sizes'][t][1] >= 1) {
+            target = t;
+        }
+    });
+    return [size[1] / units['sizes'][target][1], target];
+}
+
+function scaleIngredient(ingredient, factor, units, system) {
+    if (ingredient['quantity'] === undefined) {
+        return ingredient['raw'];
+    }
+    let unit = ingredient['unit'];
+    const converted = convertUnit(ingredient['quantity'] * factor, unit, units, system);
+    if (converted) {
+        factor *= converted[0];
+        unit = converted[1];
+    }
+    const decimal = system === 'metric' && converted !== null;
+    let text = formatQuantity(ingredient['quantity'] * factor, decimal);
+    if (ingredient['max'] !== undefined) {
+        text += `-${formatQuantity(ingredient['max'] * factor, decimal)}`;
+    }
+    if (unit) {
+        text += ` ${unit}`;
+    }
+    text += ` ${ingredient['name']}`;
+    if (ingredient['notes']) {
+        text += ` (${ingredient['notes']})`;
+    }
+    return text;
+}
+
+
+
+
 document.addEventListener('DOMContentLoaded', function() {
     const recipe = JSON.parse(`${document.getElementById('recipe').innerText}`);
 
@@ -165,6 +230,24 @@ document.addEventListener('DOMContentLoaded', function() {
         ingredients.appendChild(li);
     });
 
+    // Scaling and units  ---  Ingredients are parsed when the recipe is saved, so this is just multiplication
+    const parsed = recipe['recipeIngredientParsed'];
+    if (parsed && parsed.length === ingredients.children.length) {
+        const units = JSON.parse(document.getElementById('units').innerText);
+        const scale = document.getElementById('scale');
+        const system = document.getElementById('unit-system');
+        scale.style.display = '';
+        system.style.display = '';
+        const update = () => {
+            const factor = parseFloat(scale.value);
+            parsed.forEach((ingredient, i) => {
+                ingredients.children[i].innerText = factor === 1 && !system.value ? ingredient['raw'] : scaleIngredient(ingredient, factor, units, system.value);
+            });
+        };
+        scale.addEventListener('change', update);
+        system.addEventListener('change', update);
+    }
+
     // Directions
     const directions = document.getElementById('directions');
     var counter = 1;
@@ -0,0 +1,59 @@
+// Service worker -> keeps the cards page usable offline
+// Card data itself lives in IndexedDB (see cards.js), this only caches the page and assets
+const CACHE = 'recipe-cards-v1';
+const ASSETS = [
+    '/static/cards.js',
+    '/static/styles.css',
+    '/static/dark.css',
+    '/static/logo-black.svg',
+    '/static/logo-white.svg',
+    '/static/logo48.png'
+];
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(ASSETS)));
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', event => {
+    // Remove caches from older versions
+    event.waitUntil(
+        caches.keys().then(keys => Promise.all(keys.filter(key => key !== CACHE).map(key => caches.delete(key))))
+    );
+    self.clients.claim();
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+
+    // Cards page -> network first, saved copy when offline
+    if (url.origin === location.origin && url.pathname === '/cards') {
+        event.respondWith(
+            fetch(request)
+            .then(response => {
+                // Don't cache the login page if the session expired
+                if (response.ok && !response.redirected) {
+                    const copy = response.clone();
+                    caches.open(CACHE).then(cache => cache.put(request, copy));
+                }
+                return response;
+            })
+            .catch(() => caches.match(request))
+        );
+    // Static files and versioned CDN libraries -> cache first, refreshed in the background
+    } else if ((url.origin === location.origin && url.pathname.startsWith('/static/')) || url.origin === 'https://cdn.jsdelivr.net') {
+        event.respondWith(
+            caches.open(CACHE).then(cache => cache.match(request).then(cached => {
+                const network = fetch(request).then(response => {
+                    if (response.ok || response.type === 'opaque') {
+                        cache.put(request, response.clone());
+                    }
+                    return response;
+                }).catch(() => cached);
+                return cached || network;
+            }))
+        );
+    }
+});